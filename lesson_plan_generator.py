@@ -1,166 +1,360 @@
 import streamlit as st
-import google.generativeai as genai
 import json
+try:
+    # Optional faster parser for the model's JSON reply
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 from datetime import date
 import io
+import functools
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.parse
-import random
 import re
-
-# --- NEW LIBRARY FOR WORD DOCS ---
-from docx import Document
-from docx.shared import Inches, Pt, Mm
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import nsdecls
-from docx.oxml import parse_xml
+import string
+import zlib
+from xml.sax.saxutils import escape
+# typing_extensions (not typing) so pydantic can convert the schema on Python < 3.12
+from typing_extensions import TypedDict
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="DLP Generator", layout="centered")
 
+# Characters allowed after a ^/_ marker in format_text
+_SCRIPT_CHARS = frozenset(string.ascii_letters + string.digits + '-')
+
+# Run properties for ^ (superscript) and _ (subscript) text in raw run XML
+RUN_NORMAL, RUN_SUPER, RUN_SUB = 0, 1, 2
+_VERT_ALIGN_XML = {
+    RUN_SUPER: '<w:vertAlign w:val="superscript"/>',
+    RUN_SUB: '<w:vertAlign w:val="subscript"/>',
+}
+_RUN_BREAK_RE = re.compile(r'([\t\n\r])')
+
+# Longest side (px) of an embedded picture; 3.5in wide needs far less than a phone photo
+_MAX_IMAGE_PX = 1200
+
+# Precompiled patterns for the image-prompt cleanup
+_WS_RE = re.compile(r'[\n\r\t]')
+_ALNUM_RE = re.compile(r'[^a-zA-Z0-9 ]')
+
 # --- 2. AI GENERATOR ---
+# Must match the assess_q* fields in Evaluation below
+NUM_ASSESSMENT_QUESTIONS = 5
+
+# Response schema sent to Gemini; mirrors the keys create_docx reads
+class Resources(TypedDict):
+    guide: str
+    materials: str
+    textbook: str
+    portal: str
+    other: str
+
+class Procedure(TypedDict):
+    review: str
+    purpose_situation: str
+    visual_prompt: str
+    vocabulary: str
+    activity_main: str
+    explicitation: str
+    group_1: str
+    group_2: str
+    group_3: str
+    generalization: str
+
+class Evaluation(TypedDict):
+    assess_q1: str
+    assess_q2: str
+    assess_q3: str
+    assess_q4: str
+    assess_q5: str
+    assignment: str
+    remarks: str
+    reflection: str
+
+class LessonPlan(TypedDict):
+    obj_1: str
+    obj_2: str
+    obj_3: str
+    topic: str
+    integration_within: str
+    integration_across: str
+    resources: Resources
+    procedure: Procedure
+    evaluation: Evaluation
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_model(api_key):
+    """Configures Gemini once per API key and reuses the model client across reruns."""
+    # Imported here: google.generativeai alone takes ~0.5s, which would delay first paint
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    # Using a standard model that is generally available
+    return genai.GenerativeModel('gemini-2.5-flash')
+
+class _CacheMiss(Exception):
+    """Raised by _cached_lesson_content on a lookup miss (exceptions are never cached)."""
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _cached_lesson_content(subject, grade, quarter, content_std, perf_std, competency, _result=None):
+    """Holds parsed DLP dicts per lesson input. Call without _result to look up, with it to store.
+    Must stay free of st.* calls: Streamlit replays those on cache hits."""
+    if _result is None:
+        raise _CacheMiss
+    return _result
+
+def _request_lesson_content(api_key, subject, grade, quarter, content_std, perf_std, competency, on_progress=None):
+    """Calls Gemini and returns the DLP dict (uncached, so it may drive UI progress)."""
+    model = get_gemini_model(api_key)
+    
+    prompt = f"""
+    You are an expert teacher. Write a Daily Lesson Plan (DLP).
+    Subject: {subject}, Grade: {grade}, Quarter: {quarter}
+    Content Standard: {content_std}
+    Performance Standard: {perf_std}
+    Learning Competency: {competency}
+
+    obj_1/obj_2/obj_3 are the cognitive, psychomotor and affective objectives.
+    Write math like 3x^2 and chemistry like H_2O. The visual_prompt is a simple
+    3-word visual description (e.g. 'Red Apple Fruit'), NO sentences.
+    CRITICAL INSTRUCTION: You MUST generate exactly 5 distinct assessment questions.
+    """
+    
+    # Stream the reply so the UI can show progress; the schema guarantees the JSON shape
+    stream = model.generate_content(
+        prompt,
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": LessonPlan,
+        },
+        stream=True,
+    )
+    chunks = []
+    received = 0
+    for chunk in stream:
+        if not chunk.parts:
+            continue
+        chunks.append(chunk.text)
+        received += len(chunks[-1])
+        if on_progress:
+            on_progress(received)
+    text = "".join(chunks)
+    return _json_loads(text)
+
 def generate_lesson_content(api_key, subject, grade, quarter, content_std, perf_std, competency):
+    # Cached on the lesson inputs (not the key); only successful results are stored
+    inputs = (subject, grade, quarter, content_std, perf_std, competency)
     try:
-        genai.configure(api_key=api_key)
-        
-        # Using a standard model that is generally available
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        prompt = f"""
-        You are an expert teacher. Create a JSON object for a Daily Lesson Plan (DLP).
-        Subject: {subject}, Grade: {grade}, Quarter: {quarter}
-        Content Standard: {content_std}
-        Performance Standard: {perf_std}
-        Learning Competency: {competency}
-
-        CRITICAL INSTRUCTION: You MUST generate exactly 5 distinct assessment questions.
-
-        Return ONLY raw JSON. No markdown formatting.
-        Structure:
-        {{
-            "obj_1": "Cognitive objective",
-            "obj_2": "Psychomotor objective",
-            "obj_3": "Affective objective",
-            "topic": "The main topic (include math equations like 3x^2 if needed)",
-            "integration_within": "Topic within same subject",
-            "integration_across": "Topic across other subject",
-            "resources": {{
-                "guide": "Teacher Guide reference",
-                "materials": "Learner Materials reference",
-                "textbook": "Textbook reference",
-                "portal": "Learning Resource Portal reference",
-                "other": "Other Learning Resources"
-            }},
-            "procedure": {{
-                "review": "Review activity",
-                "purpose_situation": "Real-life situation motivation description",
-                "visual_prompt": "A simple 3-word visual description. Example: 'Red Apple Fruit'. NO sentences.",
-                "vocabulary": "5 terms with definitions",
-                "activity_main": "Main activity description",
-                "explicitation": "Discussion details",
-                "group_1": "Group 1 task",
-                "group_2": "Group 2 task",
-                "group_3": "Group 3 task",
-                "generalization": "Reflection questions"
-            }},
-            "evaluation": {{
-                "assess_q1": "Question 1 (Multiple choice or identification)",
-                "assess_q2": "Question 2",
-                "assess_q3": "Question 3",
-                "assess_q4": "Question 4",
-                "assess_q5": "Question 5",
-                "assignment": "Assignment task",
-                "remarks": "Remarks",
-                "reflection": "Reflection"
-            }}
-        }}
-        """
-        
-        response = model.generate_content(prompt)
-        text = response.text
-        # Clean potential markdown
-        if "```json" in text:
-            text = text.replace("```json", "").replace("```", "")
-        return json.loads(text)
-        
+        return _cached_lesson_content(*inputs)
+    except _CacheMiss:
+        pass
+
+    progress = st.empty()
+    try:
+        ai_data = _request_lesson_content(
+            api_key, *inputs,
+            on_progress=lambda n: progress.caption(f"Receiving lesson content... {n} chars")
+        )
+        return _cached_lesson_content(*inputs, _result=ai_data)
     except Exception as e:
         st.error(f"AI Error: {e}")
         return None
+    finally:
+        progress.empty()
 
 # --- 3. IMAGE FETCHER ---
+# A 600x350 JPEG is well under 200 KB; anything past this is not worth waiting for
+_MAX_IMAGE_BYTES = 2_000_000
+
+# Shared session so repeated image fetches reuse the TLS connection to pollinations
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504)),
+))
+
+@st.cache_data(persist="disk", max_entries=256, show_spinner=False)
+def _download_image(clean_prompt):
+    """Downloads the image bytes for a cleaned prompt. Raises on failure so errors aren't cached."""
+    encoded_prompt = urllib.parse.quote(clean_prompt)
+    # Stable seed (str hash() is salted per process) so the URL, and any CDN cache, repeats
+    seed = zlib.adler32(clean_prompt.encode()) & 0xFFFF
+    
+    url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width=600&height=350&nologo=true&seed={seed}"
+    
+    # Separate connect/read timeouts; stream so an oversized reply is cut off early
+    with _SESSION.get(url, timeout=(3, 7), stream=True) as response:
+        response.raise_for_status()
+        if int(response.headers.get('content-length', 0)) > _MAX_IMAGE_BYTES:
+            raise ValueError("Image too large")
+        buf = io.BytesIO()
+        for chunk in response.iter_content(65536):
+            buf.write(chunk)
+            if buf.tell() > _MAX_IMAGE_BYTES:
+                raise ValueError("Image too large")
+        return buf.getvalue()
+
 def fetch_ai_image(keywords):
     if not keywords: keywords = "school_classroom"
     # Clean up the prompt
-    clean_prompt = re.sub(r'[\n\r\t]', ' ', str(keywords))
-    clean_prompt = re.sub(r'[^a-zA-Z0-9 ]', '', clean_prompt).strip()
-    
-    encoded_prompt = urllib.parse.quote(clean_prompt)
-    seed = random.randint(1, 9999)
-    
-    # FIXED: Removed the markdown formatting from the URL string
-    url = f"[https://image.pollinations.ai/prompt/](https://image.pollinations.ai/prompt/){encoded_prompt}?width=600&height=350&nologo=true&seed={seed}"
+    clean_prompt = _WS_RE.sub(' ', str(keywords))
+    clean_prompt = _ALNUM_RE.sub('', clean_prompt).strip()
     
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            return io.BytesIO(response.content)
+        return _download_image(clean_prompt)
     except Exception:
         return None
-    return None
 
 # --- 4. DOCX HELPERS ---
-def set_cell_background(cell, color_hex):
-    """Sets the background color of a table cell."""
-    shading_elm = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color_hex))
-    cell._tc.get_or_add_tcPr().append(shading_elm)
+@functools.lru_cache(maxsize=512)
+def _parse_format(text):
+    """Splits text into (piece, RUN_*) runs on ^/_ markers; cached since labels repeat every build."""
+    if "^" not in text and "_" not in text:
+        return ((text, RUN_NORMAL),)
+
+    runs = []
+    n = len(text)
+    start = i = 0
+    # Single pass: plain text accumulates until a marker, which takes the
+    # following run of [0-9A-Za-z-] as its script text
+    while i < n:
+        marker = text[i]
+        if marker != '^' and marker != '_':
+            i += 1
+            continue
+        j = i + 1
+        while j < n and text[j] in _SCRIPT_CHARS:
+            j += 1
+        if j == i + 1:
+            # Bare marker (nothing to raise/lower), keep it as plain text
+            i += 1
+            continue
+        
+        if start < i:
+            runs.append((text[start:i], RUN_NORMAL))
+        runs.append((text[i + 1:j], RUN_SUPER if marker == '^' else RUN_SUB))
+        start = i = j
+
+    if start < n:
+        runs.append((text[start:], RUN_NORMAL))
+    return tuple(runs)
+
+def _apply(paragraph, runs):
+    """Adds pre-parsed runs to a paragraph."""
+    add_run = paragraph.add_run
+    for piece, kind in runs:
+        run = add_run(piece)
+        if kind == RUN_SUPER:
+            run.font.superscript = True
+        elif kind == RUN_SUB:
+            run.font.subscript = True
 
 def format_text(paragraph, text):
     """Parses text for ^ (superscript) and _ (subscript)."""
     if not text:
         return
-
-    pattern = r"([^\^_]*)(([\^_])([0-9a-zA-Z\-]+))(.*)"
-    current_text = str(text)
-    
-    if "^" not in current_text and "_" not in current_text:
-        paragraph.add_run(current_text)
-        return
-
-    while True:
-        match = re.match(pattern, current_text)
-        if match:
-            pre_text = match.group(1)
-            marker = match.group(3)
-            script_text = match.group(4)
-            rest = match.group(5)
-            
-            if pre_text:
-                paragraph.add_run(pre_text)
-            
-            run = paragraph.add_run(script_text)
-            if marker == '^':
-                run.font.superscript = True
-            elif marker == '_':
-                run.font.subscript = True
-                
-            current_text = rest
-            if not current_text:
-                break
-        else:
-            paragraph.add_run(current_text)
-            break
-
-def add_row(table, label, content, bold_label=True):
-    """Adds a row and applies formatting to the content."""
-    row_cells = table.add_row().cells
-    
-    # Label Column (Left)
-    p_lbl = row_cells[0].paragraphs[0]
-    run_lbl = p_lbl.add_run(label)
-    if bold_label:
-        run_lbl.bold = True
-    
+    _apply(paragraph, _parse_format(str(text)))
+
+@functools.lru_cache(maxsize=512)
+def _run_xml(text, bold=False, kind=RUN_NORMAL):
+    """Serializes one <w:r>, mapping newlines/tabs the way run.text does."""
+    props = ""
+    if bold:
+        props += "<w:b/>"
+    if kind != RUN_NORMAL:
+        props += _VERT_ALIGN_XML[kind]
+    parts = ["<w:r>"]
+    if props:
+        parts.append(f"<w:rPr>{props}</w:rPr>")
+    for piece in _RUN_BREAK_RE.split(text):
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\n", "\r"):
+            parts.append("<w:br/>")
+        elif piece:
+            parts.append(f'<w:t xml:space="preserve">{escape(piece)}</w:t>')
+    parts.append("</w:r>")
+    return "".join(parts)
+
+def _format_text_xml(text, bold=False):
+    """Same parsing as format_text, but returns the runs as XML."""
+    if not text:
+        return ""
+    return "".join(_run_xml(piece, bold, kind) for piece, kind in _parse_format(str(text)))
+
+def set_column_widths(table, *inches):
+    """Writes the table's <w:tblGrid> in one go (and syncs any existing cells' widths)."""
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls, qn
+    twips = [round(w * 1440) for w in inches]
+    tbl = table._tbl
+    tbl.remove(tbl.tblGrid)
+    tbl.tblPr.addnext(parse_xml(
+        f'<w:tblGrid {nsdecls("w")}>'
+        + "".join(f'<w:gridCol w:w="{w}"/>' for w in twips)
+        + '</w:tblGrid>'
+    ))
+    for tr in tbl.tr_lst:
+        for tc, w in zip(tr.tc_lst, twips):
+            tc.get_or_add_tcPr().get_or_add_tcW().set(qn('w:w'), str(w))
+
+def _optimize_image(bio):
+    """Downscales large images (phone photos) and re-encodes them as JPEG before embedding."""
+    from PIL import Image, ImageOps
+    try:
+        bio.seek(0)
+        img = Image.open(bio)
+        # EXIF tag 0x0112 = Orientation; 1 means the pixels are already upright
+        if max(img.size) <= _MAX_IMAGE_PX and img.getexif().get(0x0112, 1) == 1:
+            bio.seek(0)
+            return bio
+        # Re-encoding drops EXIF, so bake the orientation in first (portrait phone photos)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((_MAX_IMAGE_PX, _MAX_IMAGE_PX), Image.LANCZOS)
+        if img.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto white instead of letting JPEG turn it black
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, "white")
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        out.seek(0)
+        return out
+    except Exception:
+        # Let add_picture deal with anything Pillow can't read
+        bio.seek(0)
+        return bio
+
+@functools.lru_cache(maxsize=1)
+def _template_bytes():
+    """python-docx's default.docx, read from disk once and reused for every build."""
+    import docx
+    return pathlib.Path(docx.__file__).parent.joinpath('templates', 'default.docx').read_bytes()
+
+def _grid_widths(table):
+    """Column widths of the table grid in twips (dxa), for the cells' <w:tcW>."""
+    return [int(grid_col.w / 635) for grid_col in table._tbl.tblGrid.gridCol_lst]
+
+def _tr_xml(widths, label, content_xml, bold_label=True):
+    """A label/content <w:tr>; content_xml is the right cell's <w:p> markup."""
+    w_lbl, w_content = widths
+    return (
+        f'<w:tr><w:tc><w:tcPr><w:tcW w:w="{w_lbl}" w:type="dxa"/></w:tcPr>'
+        f'<w:p>{_run_xml(label, bold_label)}</w:p></w:tc>'
+        f'<w:tc><w:tcPr><w:tcW w:w="{w_content}" w:type="dxa"/></w:tcPr>'
+        f'{content_xml}</w:tc></w:tr>'
+    )
+
+def row_xml(widths, label, content, bold_label=True):
+    """A row with formatting applied to the content."""
     # Content Column (Right)
     text_content = ""
     if isinstance(content, list):
@@ -168,20 +362,31 @@ def add_row(table, label, content, bold_label=True):
     else:
         text_content = str(content) if content else ""
     
-    format_text(row_cells[1].paragraphs[0], text_content)
-
-def add_section_header(table, text):
-    """Adds a full-width section header with Blue background."""
-    row = table.add_row()
-    row.cells[0].merge(row.cells[1])
-    cell = row.cells[0]
-    cell.text = text
-    cell.paragraphs[0].runs[0].bold = True
-    set_cell_background(cell, "BDD7EE")
+    return _tr_xml(widths, label, f'<w:p>{_format_text_xml(text_content)}</w:p>', bold_label)
+
+def section_header_xml(widths, text):
+    """A full-width section header with Blue background."""
+    return (
+        f'<w:tr><w:tc><w:tcPr><w:tcW w:w="{sum(widths)}" w:type="dxa"/><w:gridSpan w:val="2"/>'
+        f'<w:shd w:val="clear" w:color="auto" w:fill="BDD7EE"/></w:tcPr>'
+        f'<w:p>{_run_xml(text, bold=True)}</w:p></w:tc></w:tr>'
+    )
+
+def append_rows(table, rows):
+    """Parses all row XML in one go and appends it; table.add_row() re-walks the table per call."""
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+    parsed = parse_xml(f'<w:tbl {nsdecls("w")}>{"".join(rows)}</w:tbl>')
+    table._tbl.extend(list(parsed))
 
 # --- 5. DOCX CREATOR ---
-def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
-    doc = Document()
+def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image, image_future=None):
+    # --- WORD DOC LIBRARY --- (imported on first use to keep app start-up fast)
+    from docx import Document
+    from docx.shared import Inches, Pt, Mm
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    doc = Document(io.BytesIO(_template_bytes()))
     
     # --- SETUP A4 PAGE SIZE & MARGINS ---
     section = doc.sections[0]
@@ -202,18 +407,16 @@ def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
     table_top = doc.add_table(rows=1, cols=4)
     table_top.style = 'Table Grid'
     table_top.autofit = False
-    
-    table_top.columns[0].width = Inches(2.5)
-    table_top.columns[1].width = Inches(1.15)
-    table_top.columns[2].width = Inches(1.15)
-    table_top.columns[3].width = Inches(2.5)
+    set_column_widths(table_top, 2.5, 1.15, 1.15, 2.5)
+
+    # Resolve the row's cells once; each .cells/.paragraphs access rebuilds proxies
+    top_cells = table_top.rows[0].cells
 
     def fill_cell(idx, label, value):
-        cell = table_top.rows[0].cells[idx]
-        p = cell.paragraphs[0]
-        p.add_run(label).bold = True
-        p.add_run("\n")
-        format_text(p, value)
+        p0 = top_cells[idx].paragraphs[0]
+        p0.add_run(label).bold = True
+        p0.add_run("\n")
+        format_text(p0, value)
 
     fill_cell(0, "Subject Area:", inputs['subject'])
     fill_cell(1, "Grade Level:", inputs['grade'])
@@ -224,9 +427,7 @@ def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
     table_main = doc.add_table(rows=0, cols=2)
     table_main.style = 'Table Grid'
     table_main.autofit = False
-    
-    table_main.columns[0].width = Inches(2.0)
-    table_main.columns[1].width = Inches(5.3)
+    set_column_widths(table_main, 2.0, 5.3)
 
     # Process Data
     objs = f"1. {ai_data.get('obj_1','')}\n2. {ai_data.get('obj_2','')}\n3. {ai_data.get('obj_3','')}"
@@ -234,76 +435,50 @@ def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
     proc = ai_data.get('procedure', {})
     eval_sec = ai_data.get('evaluation', {})
 
-    # SECTION I
-    add_section_header(table_main, "I. CURRICULUM CONTENT, STANDARD AND LESSON COMPETENCIES")
-    add_row(table_main, "A. Content Standard", inputs['content_std'])
-    add_row(table_main, "B. Performance Standard", inputs['perf_std'])
-    
-    row_comp = table_main.add_row().cells
-    row_comp[0].paragraphs[0].add_run("C. Learning Competencies").bold = True
-    p_comp = row_comp[1].paragraphs[0]
-    p_comp.add_run("Competency: ").bold = True
-    format_text(p_comp, inputs['competency'])
-    p_comp.add_run("\n\nObjectives:\n").bold = True
-    p_comp.add_run(objs)
+    # The layout is fixed, so the whole table is rendered as XML and parsed once
+    widths = _grid_widths(table_main)
+    rows = []
 
-    add_row(table_main, "D. Content", ai_data.get('topic', ''))
-    add_row(table_main, "E. Integration", f"Within: {ai_data.get('integration_within','')}\nAcross: {ai_data.get('integration_across','')}")
+    # SECTION I
+    rows.append(section_header_xml(widths, "I. CURRICULUM CONTENT, STANDARD AND LESSON COMPETENCIES"))
+    rows.append(row_xml(widths, "A. Content Standard", inputs['content_std']))
+    rows.append(row_xml(widths, "B. Performance Standard", inputs['perf_std']))
+    rows.append(_tr_xml(widths, "C. Learning Competencies",
+        '<w:p>'
+        + _run_xml("Competency: ", bold=True)
+        + _format_text_xml(inputs['competency'])
+        + _run_xml("\n\nObjectives:\n", bold=True)
+        + _run_xml(objs)
+        + '</w:p>'))
+    rows.append(row_xml(widths, "D. Content", ai_data.get('topic', '')))
+    rows.append(row_xml(widths, "E. Integration", f"Within: {ai_data.get('integration_within','')}\nAcross: {ai_data.get('integration_across','')}"))
 
     # SECTION II
-    add_section_header(table_main, "II. LEARNING RESOURCES")
-    add_row(table_main, "Teacher Guide", r.get('guide', ''))
-    add_row(table_main, "Learner’s Materials(LMs)", r.get('materials', ''))
-    add_row(table_main, "Textbooks", r.get('textbook', ''))
-    add_row(table_main, "Learning Resource (LR) Portal", r.get('portal', ''))
-    add_row(table_main, "Other Learning Resources", r.get('other', ''))
+    rows.append(section_header_xml(widths, "II. LEARNING RESOURCES"))
+    rows.append(row_xml(widths, "Teacher Guide", r.get('guide', '')))
+    rows.append(row_xml(widths, "Learner’s Materials(LMs)", r.get('materials', '')))
+    rows.append(row_xml(widths, "Textbooks", r.get('textbook', '')))
+    rows.append(row_xml(widths, "Learning Resource (LR) Portal", r.get('portal', '')))
+    rows.append(row_xml(widths, "Other Learning Resources", r.get('other', '')))
 
     # SECTION III
-    add_section_header(table_main, "III. TEACHING AND LEARNING PROCEDURE")
-    add_row(table_main, "A. Activating Prior Knowledge", proc.get('review', ''))
-    
-    # --- IMAGE ROW ---
-    row_img = table_main.add_row().cells
-    row_img[0].paragraphs[0].add_run("B. Establishing Lesson Purpose").bold = True
-    
-    cell_img = row_img[1]
-    format_text(cell_img.paragraphs[0], proc.get('purpose_situation', ''))
-    cell_img.paragraphs[0].add_run("\n")
+    rows.append(section_header_xml(widths, "III. TEACHING AND LEARNING PROCEDURE"))
+    rows.append(row_xml(widths, "A. Activating Prior Knowledge", proc.get('review', '')))
     
-    img_data = None
-    if uploaded_image:
-        img_data = uploaded_image
-    else:
-        raw_prompt = proc.get('visual_prompt', 'school')
-        img_data = fetch_ai_image(raw_prompt)
-    
-    if img_data:
-        try:
-            p_i = cell_img.add_paragraph()
-            p_i.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run_i = p_i.add_run()
-            run_i.add_picture(img_data, width=Inches(3.5))
-        except:
-            cell_img.add_paragraph("[Image Error]")
-    else:
-        cell_img.add_paragraph("[No Image Available]")
-        
-    cell_img.add_paragraph(f"\nVocabulary:\n{proc.get('vocabulary','')}")
+    # --- IMAGE ROW --- (the centered middle paragraph is filled in once the table exists)
+    img_row_idx = len(rows)
+    rows.append(_tr_xml(widths, "B. Establishing Lesson Purpose",
+        '<w:p>' + _format_text_xml(proc.get('purpose_situation', '')) + _run_xml("\n") + '</w:p>'
+        + '<w:p><w:pPr><w:jc w:val="center"/></w:pPr></w:p>'
+        + '<w:p>' + _run_xml(f"\nVocabulary:\n{proc.get('vocabulary','')}") + '</w:p>'))
 
     # Rest of Section III
-    add_row(table_main, "C. Developing Understanding", 
-            f"Activity: {proc.get('activity_main','')}\n\nExplicitation: {proc.get('explicitation','')}\n\nGroup 1: {proc.get('group_1','')}\nGroup 2: {proc.get('group_2','')}\nGroup 3: {proc.get('group_3','')}")
-    add_row(table_main, "D. Making Generalization", proc.get('generalization', ''))
+    rows.append(row_xml(widths, "C. Developing Understanding", 
+            f"Activity: {proc.get('activity_main','')}\n\nExplicitation: {proc.get('explicitation','')}\n\nGroup 1: {proc.get('group_1','')}\nGroup 2: {proc.get('group_2','')}\nGroup 3: {proc.get('group_3','')}"))
+    rows.append(row_xml(widths, "D. Making Generalization", proc.get('generalization', '')))
 
     # SECTION IV
-    add_section_header(table_main, "IV. EVALUATING LEARNING")
-    
-    # Construct list manually
-    q1 = eval_sec.get('assess_q1', 'Question 1')
-    q2 = eval_sec.get('assess_q2', 'Question 2')
-    q3 = eval_sec.get('assess_q3', 'Question 3')
-    q4 = eval_sec.get('assess_q4', 'Question 4')
-    q5 = eval_sec.get('assess_q5', 'Question 5')
+    rows.append(section_header_xml(widths, "IV. EVALUATING LEARNING"))
     
     def ensure_number(num, text):
         s_text = str(text).strip()
@@ -312,37 +487,59 @@ def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
         return f"{num}. {s_text}"
 
     assessment_list = [
-        ensure_number(1, q1),
-        ensure_number(2, q2),
-        ensure_number(3, q3),
-        ensure_number(4, q4),
-        ensure_number(5, q5)
+        ensure_number(i, eval_sec.get(f'assess_q{i}', f'Question {i}'))
+        for i in range(1, NUM_ASSESSMENT_QUESTIONS + 1)
     ]
     
-    add_row(table_main, "A. Assessment", assessment_list)
-    add_row(table_main, "B. Assignment", eval_sec.get('assignment', ''))
-    add_row(table_main, "C. Remarks", eval_sec.get('remarks', ''))
-    add_row(table_main, "D. Reflection", eval_sec.get('reflection', ''))
+    rows.append(row_xml(widths, "A. Assessment", assessment_list))
+    rows.append(row_xml(widths, "B. Assignment", eval_sec.get('assignment', '')))
+    rows.append(row_xml(widths, "C. Remarks", eval_sec.get('remarks', '')))
+    rows.append(row_xml(widths, "D. Reflection", eval_sec.get('reflection', '')))
+
+    append_rows(table_main, rows)
+
+    # Picture goes in through python-docx so the image part and relationship are created
+    p_img = table_main.rows[img_row_idx].cells[1].paragraphs[1]
+    img_data = None
+    if uploaded_image:
+        img_data = uploaded_image
+    else:
+        # Prefer the fetch main() already started; only block on it here
+        if image_future is not None:
+            img_bytes = image_future.result()
+        else:
+            img_bytes = fetch_ai_image(proc.get('visual_prompt', 'school'))
+        if img_bytes:
+            img_data = io.BytesIO(img_bytes)
+    
+    if img_data:
+        try:
+            # The upload may have been read before (e.g. on an earlier submit)
+            img_data.seek(0)
+            p_img.add_run().add_picture(_optimize_image(img_data), width=Inches(3.5))
+        except:
+            p_img.alignment = None
+            p_img.add_run("[Image Error]")
+    else:
+        p_img.alignment = None
+        p_img.add_run("[No Image Available]")
 
     doc.add_paragraph()
 
     # --- SIGNATORIES TABLE (Completed) ---
     sig_table = doc.add_table(rows=2, cols=2)
     sig_table.autofit = False
-    sig_table.columns[0].width = Inches(3.65)
-    sig_table.columns[1].width = Inches(3.65)
+    set_column_widths(sig_table, 3.65, 3.65)
     
-    # Headers
-    sig_table.rows[0].cells[0].text = "Prepared by:"
-    sig_table.rows[0].cells[1].text = "Noted by:"
+    sig_headers, sig_names = (row.cells for row in sig_table.rows)
     
-    # Names
-    sig_table.rows[1].cells[0].text = f"\n\n{teacher_name}\nTeacher"
-    sig_table.rows[1].cells[1].text = f"\n\n{principal_name}\nPrincipal"
+    # Headers
+    sig_headers[0].text = "Prepared by:"
+    sig_headers[1].text = "Noted by:"
     
-    # Bold names
-    sig_table.rows[1].cells[0].paragraphs[0].runs[0].bold = True
-    sig_table.rows[1].cells[1].paragraphs[0].runs[0].bold = True
+    # Names (bold)
+    sig_names[0].paragraphs[0].add_run(f"\n\n{teacher_name}\nTeacher").bold = True
+    sig_names[1].paragraphs[0].add_run(f"\n\n{principal_name}\nPrincipal").bold = True
 
     # Save to memory
     file_stream = io.BytesIO()
@@ -351,21 +548,9 @@ def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
     return file_stream
 
 # --- 6. STREAMLIT UI (MAIN) ---
-def main():
-    st.title("📄 AI Lesson Plan Generator (Docx)")
-    st.write("Fill in the details below to generate a DepEd-style DLP.")
-
-    # Sidebar for API Key
-    with st.sidebar:
-        st.header("Settings")
-        api_key = st.text_input("Google API Key", type="password")
-        if not api_key:
-            # Check secrets
-            if "GOOGLE_API_KEY" in st.secrets:
-                api_key = st.secrets["GOOGLE_API_KEY"]
-            else:
-                st.warning("Please enter your API Key or set it in Secrets.")
-
+@st.fragment
+def _generator_fragment(api_key):
+    """Form + generation; submitting reruns only this fragment, not the whole page."""
     # Form
     with st.form("dlp_form"):
         col1, col2 = st.columns(2)
@@ -384,6 +569,11 @@ def main():
         uploaded_file = st.file_uploader("Upload Image (Optional)", type=['png', 'jpg', 'jpeg'])
         submit_btn = st.form_submit_button("Generate Lesson Plan")
 
+    # A new submit replaces whatever was generated before, even if it fails
+    if submit_btn:
+        st.session_state.pop('docx_file', None)
+        st.session_state.pop('docx_name', None)
+
     # Processing
     if submit_btn and api_key:
         with st.spinner("Consulting AI... Generating Content..."):
@@ -396,37 +586,66 @@ def main():
             if ai_data:
                 st.success("Content Generated! Creating Word Document...")
                 
-                # 2. Convert Uploaded Image
+                # 2. Uploaded Image (UploadedFile is already a BytesIO; no copy needed)
                 user_img = None
                 if uploaded_file is not None:
-                    user_img = io.BytesIO(uploaded_file.getvalue())
-
-                # 3. Create DOCX
-                docx_file = create_docx(
-                    inputs={
-                        "subject": subject,
-                        "grade": grade,
-                        "quarter": quarter,
-                        "content_std": content_std,
-                        "perf_std": perf_std,
-                        "competency": competency
-                    },
-                    ai_data=ai_data,
-                    teacher_name=teacher_name,
-                    principal_name=principal_name,
-                    uploaded_image=user_img
-                )
-
-                # 4. Download Button
-                st.download_button(
-                    label="📥 Download DLP (.docx)",
-                    data=docx_file,
-                    file_name=f"DLP_{subject}_{grade}.docx",
-                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                )
+                    uploaded_file.seek(0)
+                    user_img = uploaded_file
+
+                # 3. Create DOCX (the AI image downloads while the tables are built)
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    image_future = None
+                    if user_img is None:
+                        visual_prompt = ai_data.get('procedure', {}).get('visual_prompt', 'school')
+                        image_future = executor.submit(fetch_ai_image, visual_prompt)
+                    docx_file = create_docx(
+                        inputs={
+                            "subject": subject,
+                            "grade": grade,
+                            "quarter": quarter,
+                            "content_std": content_std,
+                            "perf_std": perf_std,
+                            "competency": competency
+                        },
+                        ai_data=ai_data,
+                        teacher_name=teacher_name,
+                        principal_name=principal_name,
+                        uploaded_image=user_img,
+                        image_future=image_future
+                    )
+
+                # 4. Keep the result so the download survives later reruns
+                st.session_state['docx_file'] = docx_file.getvalue()
+                st.session_state['docx_name'] = f"DLP_{subject}_{grade}.docx"
             else:
                 st.error("Failed to generate content. Please try again.")
 
+    # Download Button (inside the fragment so a new submit also redraws/clears it)
+    if 'docx_file' in st.session_state:
+        st.download_button(
+            label="📥 Download DLP (.docx)",
+            data=st.session_state['docx_file'],
+            file_name=st.session_state['docx_name'],
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        )
+
+def main():
+    st.title("📄 AI Lesson Plan Generator (Docx)")
+    st.write("Fill in the details below to generate a DepEd-style DLP.")
+
+    # Sidebar for API Key
+    with st.sidebar:
+        st.header("Settings")
+        api_key = st.text_input("Google API Key", type="password")
+        if not api_key:
+            # Check secrets
+            if "GOOGLE_API_KEY" in st.secrets:
+                api_key = st.secrets["GOOGLE_API_KEY"]
+            else:
+                st.warning("Please enter your API Key or set it in Secrets.")
+
+    _generator_fragment(api_key)
+
 if __name__ == "__main__":
     main()
 
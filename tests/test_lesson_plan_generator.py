@@ -0,0 +1,101 @@
+from streamlit.testing.v1 import AppTest
+
+
+def _repeat_generation_script():
+    import json
+    import streamlit as st
+    import lesson_plan_generator as lpg
+
+    calls = st.session_state.setdefault("model_calls", [])
+
+    class _Chunk:
+        def __init__(self, text):
+            self.text = text
+            self.parts = [text]
+
+    class _FakeModel:
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            calls.append(prompt)
+            text = json.dumps({"topic": "Fractions"})
+            return [_Chunk(text[:5]), _Chunk(text[5:])]
+
+    lpg.get_gemini_model = lambda api_key: _FakeModel()
+    st.session_state["result"] = lpg.generate_lesson_content(
+        "key", "Math", "Grade 7", "1st Quarter", "cs", "ps", "competency"
+    )
+
+
+def test_repeat_generation_hits_cache_without_error():
+    at = AppTest.from_function(_repeat_generation_script)
+    at.run()
+    assert at.session_state["result"] == {"topic": "Fractions"}
+
+    at.run()
+    assert not at.exception
+    assert not at.error
+    assert at.session_state["result"] == {"topic": "Fractions"}
+    assert len(at.session_state["model_calls"]) == 1
+
+
+def test_failed_submit_clears_previous_download(monkeypatch):
+    import json
+    from pathlib import Path
+
+    import google.generativeai as genai
+    import requests
+
+    class _Chunk:
+        def __init__(self, text):
+            self.text = text
+            self.parts = [text]
+
+    class _FakeModel:
+        fail = False
+
+        def __init__(self, name):
+            pass
+
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            if _FakeModel.fail:
+                raise RuntimeError("quota exceeded")
+            return [_Chunk(json.dumps({"topic": "Fractions"}))]
+
+    monkeypatch.setattr(genai, "GenerativeModel", _FakeModel)
+    monkeypatch.setattr(genai, "configure", lambda **kwargs: None)
+    # No network in tests: the image fetch fails and the docx says "[No Image Available]"
+    def _offline(*args, **kwargs):
+        raise requests.ConnectionError("offline")
+    monkeypatch.setattr(requests.Session, "get", _offline)
+
+    app = Path(__file__).resolve().parent.parent / "lesson_plan_generator.py"
+    at = AppTest.from_file(str(app), default_timeout=30)
+    at.secrets["GOOGLE_API_KEY"] = "key"
+    at.run()
+    at.button[0].click().run()
+    assert len(at.get("download_button")) == 1
+
+    # Different subject so the cached result isn't reused
+    _FakeModel.fail = True
+    at.text_input[0].input("Science")
+    at.button[0].click().run()
+    assert at.error
+    assert len(at.get("download_button")) == 0
+    assert "docx_file" not in at.session_state
+
+
+def test_optimize_image_applies_exif_orientation():
+    import io
+
+    from PIL import Image
+
+    import lesson_plan_generator as lpg
+
+    # Landscape pixels tagged "rotate 90° CW" (orientation 6): a portrait phone photo
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    src = io.BytesIO()
+    Image.new("RGB", (4000, 3000), "red").save(src, "JPEG", exif=exif)
+
+    out = Image.open(lpg._optimize_image(src))
+    assert out.size == (900, 1200)
+    assert out.getexif().get(0x0112, 1) == 1